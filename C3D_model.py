@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 from mypath import Path
 
 class C3D(nn.Module):
@@ -7,9 +8,12 @@ class C3D(nn.Module):
     The C3D network.
     """
 
-    def __init__(self, num_classes, pretrained=False):
+    def __init__(self, num_classes, pretrained=False, use_checkpoint=False):
         super(C3D, self).__init__()
 
+        # Recompute conv activations in backward instead of storing them
+        self.use_checkpoint = use_checkpoint
+
         self.conv1 = nn.Conv3d(3, 16, kernel_size=(3, 3, 3), padding=(1, 1, 1))
         self.pool1 = nn.MaxPool3d(kernel_size=(1, 2, 2), stride=(1, 2, 2))
 
@@ -43,12 +47,32 @@ class C3D(nn.Module):
 
     def forward(self, x):
 
+        for stage in (self.__stage1, self.__stage2, self.__stage3):
+            if self.use_checkpoint and self.training:
+                x = checkpoint(stage, x, use_reentrant=False)
+            else:
+                x = stage(x)
+        # print(x.shape)
+
+        x = x.reshape(-1, 29184)
+        x = self.relu(self.fc6(x))
+        x = self.dropout(x)
+        x = self.relu(self.fc7(x))
+        x = self.dropout(x)
+
+        logits = self.fc8(x)
+
+        return logits
+
+    def __stage1(self, x):
         x = self.relu(self.conv1(x))
         x = self.pool1(x)
 
         x = self.relu(self.conv2(x))
         x = self.pool2(x)
+        return x
 
+    def __stage2(self, x):
         x = self.relu(self.conv3a(x))
         x = self.relu(self.conv3b(x))
         x = self.pool3(x)
@@ -56,21 +80,13 @@ class C3D(nn.Module):
         x = self.relu(self.conv4a(x))
         x = self.relu(self.conv4b(x))
         x = self.pool4(x)
+        return x
 
+    def __stage3(self, x):
         x = self.relu(self.conv5a(x))
         x = self.relu(self.conv5b(x))
         x = self.pool5(x)
-        # print(x.shape)
-
-        x = x.view(-1, 29184)
-        x = self.relu(self.fc6(x))
-        x = self.dropout(x)
-        x = self.relu(self.fc7(x))
-        x = self.dropout(x)
-
-        logits = self.fc8(x)
-
-        return logits
+        return x
 
     def __load_pretrained_weights(self):
         """Initialiaze network."""
@@ -3,15 +3,17 @@ from datetime import datetime
 import socket
 import os
 import glob
+import warnings
 from tqdm import tqdm
 import csv  # 新增导入CSV模块
+import numpy as np
 from sklearn.metrics import roc_auc_score, accuracy_score, precision_score, recall_score
 
 import torch
 from tensorboardX import SummaryWriter
 from torch import nn, optim
+import torch.nn.functional as F
 from torch.utils.data import DataLoader
-from torch.autograd import Variable
 
 from dataloaders.dataset import VideoDataset
 from network.C3D_model import C3D
@@ -26,6 +28,8 @@ useTest = True  # See evolution of the test set when training
 nTestInterval = 1  # Run on test set every nTestInterval epochs
 snapshot = 10  # Store a model every snapshot epochs
 lr = 1e-4  # Learning rate
+nWorkers = max(1, (os.cpu_count() or 2) // 2)  # DataLoader worker processes per split
+accumSteps = 2  # Number of mini-batches to accumulate gradients over before each optimizer step
 
 dataset = 'hmdb51'  # Options: hmdb51 or ucf101
 
@@ -59,107 +63,158 @@ def save_to_csv(epoch, phase, labels, probs, save_dir):
     """
     os.makedirs(save_dir, exist_ok=True)  # 确保目录存在
     filename = os.path.join(save_dir, f'{phase}_epoch_{epoch}.csv')
-    with open(filename, 'w', newline='') as file:
+    with open(filename, 'w', newline='', buffering=1 << 20) as file:
         writer = csv.writer(file)
         writer.writerow(['TrueLabel', 'Probability'])
-        for label, prob in zip(labels, probs):
-            writer.writerow([label, prob])
+        writer.writerows(zip(labels, probs))
     print(f'Saved {phase} predictions to {filename}')
 
 
 def train_model(dataset=dataset, save_dir=save_dir, num_classes=num_classes, lr=lr,
-                num_epochs=nEpochs, save_epoch=snapshot, useTest=useTest, test_interval=nTestInterval):
-    model = C3D(num_classes=num_classes, pretrained=False)
+                num_epochs=nEpochs, save_epoch=snapshot, useTest=useTest, test_interval=nTestInterval,
+                accum_steps=accumSteps):
+    models_dir = os.path.join(save_dir, 'models')
+    predictions_dir = os.path.join(save_dir, 'predictions')
+    metric_names = ['loss', 'acc', 'auc', 'sensitivity', 'specificity']
+    scalar_tags = {phase: ['data/{}_{}_epoch'.format(phase, name) for name in metric_names]
+                   for phase in ['train', 'val', 'test']}
+
+    # Clip shapes are fixed, so let cuDNN autotune conv algorithms and allow TF32 on Ampere+
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
+    model = C3D(num_classes=num_classes, pretrained=False, use_checkpoint=True)
     criterion = nn.CrossEntropyLoss()
     optimizer = optim.Adam(model.parameters(), lr=lr, weight_decay=0.001)
-    scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=10)
 
     if resume_epoch == 0:
         print("Training {} from scratch...".format(modelName))
     else:
-        checkpoint = torch.load(os.path.join(save_dir, 'models', saveName + '_epoch-' + str(resume_epoch - 1) + '.pth.tar'),
-                       map_location=lambda storage, loc: storage)
-        print("Initializing weights from: {}".format(
-            os.path.join(save_dir, 'models', saveName + '_epoch-' + str(resume_epoch - 1) + '.pth.tar')))
+        resume_path = os.path.join(models_dir, saveName + '_epoch-' + str(resume_epoch - 1) + '.pth.tar')
+        checkpoint = torch.load(resume_path, map_location=lambda storage, loc: storage)
+        print("Initializing weights from: {}".format(resume_path))
         model.load_state_dict(checkpoint['state_dict'])
         optimizer.load_state_dict(checkpoint['opt_dict'])
 
     print('Total params: %.2fM' % (sum(p.numel() for p in model.parameters()) / 1000000.0))
     model.to(device)
+    model = model.to(memory_format=torch.channels_last_3d)
+    compiled_model = torch.compile(model, mode="max-autotune", dynamic=False) if device.type == 'cuda' else model
     criterion.to(device)
 
-    log_dir = os.path.join(save_dir, 'models', datetime.now().strftime('%b%d_%H-%M-%S') + '_' + socket.gethostname())
+    log_dir = os.path.join(models_dir, datetime.now().strftime('%b%d_%H-%M-%S') + '_' + socket.gethostname())
     writer = SummaryWriter(log_dir=log_dir)
 
     print('Training model on {} dataset...'.format(dataset))
-    train_dataloader = DataLoader(VideoDataset(dataset=dataset, split='train', clip_len=5), batch_size=4, shuffle=True, num_workers=1)
-    val_dataloader = DataLoader(VideoDataset(dataset=dataset, split='val', clip_len=5), batch_size=4, num_workers=1)
-    test_dataloader = DataLoader(VideoDataset(dataset=dataset, split='test', clip_len=5), batch_size=4, num_workers=1)
+    loader_kwargs = dict(batch_size=16, num_workers=nWorkers, pin_memory=True, persistent_workers=True, prefetch_factor=4)
+    train_dataset = VideoDataset(dataset=dataset, split='train', clip_len=5)
+    # Drop the partial last batch to keep compiled shapes static, unless the split is smaller than one batch
+    train_dataloader = DataLoader(train_dataset, shuffle=True,
+                                  drop_last=len(train_dataset) >= loader_kwargs['batch_size'], **loader_kwargs)
+    val_dataloader = DataLoader(VideoDataset(dataset=dataset, split='val', clip_len=5), **loader_kwargs)
+    test_dataloader = DataLoader(VideoDataset(dataset=dataset, split='test', clip_len=5), **loader_kwargs)
 
     trainval_loaders = {'train': train_dataloader, 'val': val_dataloader}
-    trainval_sizes = {x: len(trainval_loaders[x].dataset) for x in ['train', 'val']}
+    # Count only the train samples the loader yields once a partial last batch is dropped
+    trainval_sizes = {'train': min(len(train_dataset), len(train_dataloader) * train_dataloader.batch_size),
+                      'val': len(val_dataloader.dataset)}
     test_size = len(test_dataloader.dataset)
 
+    use_amp = device.type == 'cuda'
+    scaler = torch.amp.GradScaler('cuda', enabled=use_amp)
+
+    # Anneal over every optimizer step of the run rather than restarting each epoch
+    steps_per_epoch = (len(train_dataloader) + accum_steps - 1) // accum_steps
+    scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=num_epochs * steps_per_epoch)
+    if resume_epoch != 0:
+        if 'sched_dict' in checkpoint:
+            scheduler.load_state_dict(checkpoint['sched_dict'])
+        else:
+            # Older checkpoints carry no scheduler state; fast-forward to the resumed epoch
+            print("Checkpoint has no scheduler state, fast-forwarding LR schedule to epoch {}".format(resume_epoch))
+            # The restored LR comes from the old per-epoch schedule and may be 0; restart from the base LR
+            for group in optimizer.param_groups:
+                group['lr'] = group['initial_lr']
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', UserWarning)
+                for _ in range(resume_epoch * steps_per_epoch):
+                    scheduler.step()
+        if 'scaler_dict' in checkpoint:
+            scaler.load_state_dict(checkpoint['scaler_dict'])
+
+    # GradScaler skips optimizer.step() on inf/NaN grads; record real steps without a host sync
+    optimizer_stepped = {'flag': False}
+    optimizer.register_step_post_hook(lambda *_: optimizer_stepped.update(flag=True))
+
     for epoch in range(resume_epoch, num_epochs):
         for phase in ['train', 'val']:
             start_time = timeit.default_timer()
 
-            running_loss = 0.0
-            running_corrects = 0.0
-            running_probs = []
-            running_labels = []
+            running_loss = torch.zeros((), device=device)
+            running_corrects = torch.zeros((), dtype=torch.long, device=device)
+            probs_buf = torch.empty(trainval_sizes[phase], device=device)
+            labels_buf = torch.empty(trainval_sizes[phase], dtype=torch.long, device=device)
+            offset = 0
 
             if phase == 'train':
-                scheduler.step()
                 model.train()
+                optimizer.zero_grad(set_to_none=True)
             else:
                 model.eval()
 
-            for inputs, labels in tqdm(trainval_loaders[phase]):
-                inputs = Variable(inputs, requires_grad=True).to(device)
-                labels = Variable(labels).to(device)
-                optimizer.zero_grad()
+            num_batches = len(trainval_loaders[phase])
+            for batch_idx, (inputs, labels) in enumerate(tqdm(trainval_loaders[phase])):
+                inputs = inputs.to(device, memory_format=torch.channels_last_3d, non_blocking=True)
+                labels = labels.to(device, dtype=torch.long, non_blocking=True)
                 if phase == 'train':
-                    outputs = model(inputs)
+                    with torch.amp.autocast('cuda', enabled=use_amp):
+                        outputs = compiled_model(inputs)
+                        loss = criterion(outputs, labels)
                 else:
-                    with torch.no_grad():
-                        outputs = model(inputs)
+                    with torch.no_grad(), torch.amp.autocast('cuda', enabled=use_amp):
+                        outputs = compiled_model(inputs)
+                        loss = criterion(outputs, labels)
 
-                probs = nn.Softmax(dim=1)(outputs)
-                preds = torch.max(probs, 1)[1]
-                loss = criterion(outputs, labels.long())
+                probs = F.softmax(outputs.detach().float(), dim=1)
+                preds = outputs.argmax(1)
 
                 if phase == 'train':
-                    loss.backward()
-                    optimizer.step()
-
-                running_loss += loss.item() * inputs.size(0)
-                running_corrects += torch.sum(preds == labels.data)
-
-                running_probs.extend(probs[:, 1].tolist())
-                running_labels.extend(labels.tolist())
-
-            epoch_loss = running_loss / trainval_sizes[phase]
-            epoch_acc = running_corrects.double() / trainval_sizes[phase]
+                    # The epoch's last group may hold fewer than accum_steps mini-batches
+                    group_size = min(accum_steps, num_batches - (batch_idx // accum_steps) * accum_steps)
+                    scaler.scale(loss / group_size).backward()
+                    if (batch_idx + 1) % accum_steps == 0 or batch_idx + 1 == num_batches:
+                        optimizer_stepped['flag'] = False
+                        scaler.step(optimizer)
+                        scaler.update()
+                        optimizer.zero_grad(set_to_none=True)
+                        if optimizer_stepped['flag']:
+                            scheduler.step()
+
+                running_loss += loss.detach() * inputs.size(0)
+                running_corrects += (preds == labels).sum()
+
+                batch_len = inputs.size(0)
+                probs_buf[offset:offset + batch_len] = probs[:, 1]
+                labels_buf[offset:offset + batch_len] = labels
+                offset += batch_len
+
+            running_probs = probs_buf.cpu().numpy()
+            running_labels = labels_buf.cpu().numpy()
+
+            epoch_loss = (running_loss / trainval_sizes[phase]).item()
+            epoch_acc = running_corrects.item() / trainval_sizes[phase]
             epoch_auc = roc_auc_score(running_labels, running_probs)
-            epoch_sensitivity = recall_score(running_labels, [1 if p > 0.5 else 0 for p in running_probs])
-            epoch_specificity = recall_score(running_labels, [1 if p > 0.5 else 0 for p in running_probs], pos_label=0)
+            running_preds = (running_probs > 0.5).astype(np.int8)
+            epoch_sensitivity = recall_score(running_labels, running_preds)
+            epoch_specificity = recall_score(running_labels, running_preds, pos_label=0)
 
             # 在每个阶段的循环结束后保存预测到CSV
-            save_to_csv(epoch, phase, running_labels, running_probs, os.path.join(save_dir, 'predictions'))
+            save_to_csv(epoch, phase, running_labels, running_probs, predictions_dir)
 
-            if phase == 'train':
-                writer.add_scalar('data/train_loss_epoch', epoch_loss, epoch)
-                writer.add_scalar('data/train_acc_epoch', epoch_acc, epoch)
-                writer.add_scalar('data/train_auc_epoch', epoch_auc, epoch)
-                writer.add_scalar('data/train_sensitivity_epoch', epoch_sensitivity, epoch)
-                writer.add_scalar('data/train_specificity_epoch', epoch_specificity, epoch)
-            else:
-                writer.add_scalar('data/val_loss_epoch', epoch_loss, epoch)
-                writer.add_scalar('data/val_acc_epoch', epoch_acc, epoch)
-                writer.add_scalar('data/val_auc_epoch', epoch_auc, epoch)
-                writer.add_scalar('data/val_sensitivity_epoch', epoch_sensitivity, epoch)
-                writer.add_scalar('data/val_specificity_epoch', epoch_specificity, epoch)
+            epoch_metrics = (epoch_loss, epoch_acc, epoch_auc, epoch_sensitivity, epoch_specificity)
+            for tag, value in zip(scalar_tags[phase], epoch_metrics):
+                writer.add_scalar(tag, value, epoch)
 
             print("[{}] Epoch: {}/{} Loss: {} Acc: {} AUC: {} Sensitivity: {} Specificity: {}".format(
                 phase, epoch + 1, nEpochs, epoch_loss, epoch_acc, epoch_auc, epoch_sensitivity, epoch_specificity))
@@ -167,53 +222,61 @@ def train_model(dataset=dataset, save_dir=save_dir, num_classes=num_classes, lr=
             print("Execution time: " + str(stop_time - start_time) + "\n")
 
         if epoch % save_epoch == (save_epoch - 1):
+            model_path = os.path.join(models_dir, saveName + '_epoch-' + str(epoch) + '.pth.tar')
             torch.save({
                 'epoch': epoch + 1,
                 'state_dict': model.state_dict(),
                 'opt_dict': optimizer.state_dict(),
-            }, os.path.join(save_dir, 'models', saveName + '_epoch-' + str(epoch) + '.pth.tar'))
-            print("Save model at {}\n".format(os.path.join(save_dir, 'models', saveName + '_epoch-' + str(epoch) + '.pth.tar')))
+                'sched_dict': scheduler.state_dict(),
+                'scaler_dict': scaler.state_dict(),
+            }, model_path)
+            print("Save model at {}\n".format(model_path))
 
         if useTest and epoch % test_interval == (test_interval - 1):
             model.eval()
             start_time = timeit.default_timer()
 
-            running_loss = 0.0
-            running_corrects = 0.0
-            running_probs = []
-            running_labels = []
+            running_loss = torch.zeros((), device=device)
+            running_corrects = torch.zeros((), dtype=torch.long, device=device)
+            probs_buf = torch.empty(test_size, device=device)
+            labels_buf = torch.empty(test_size, dtype=torch.long, device=device)
+            offset = 0
 
             for inputs, labels in tqdm(test_dataloader):
-                inputs = inputs.to(device)
-                labels = labels.to(device)
+                inputs = inputs.to(device, memory_format=torch.channels_last_3d, non_blocking=True)
+                labels = labels.to(device, dtype=torch.long, non_blocking=True)
+
+                with torch.no_grad(), torch.amp.autocast('cuda', enabled=use_amp):
+                    outputs = compiled_model(inputs)
+                    loss = criterion(outputs, labels)
 
-                with torch.no_grad():
-                    outputs = model(inputs)
+                probs = F.softmax(outputs.detach().float(), dim=1)
+                preds = outputs.argmax(1)
 
-                probs = nn.Softmax(dim=1)(outputs)
-                preds = torch.max(probs, 1)[1]
-                loss = criterion(outputs, labels.long())
+                running_loss += loss.detach() * inputs.size(0)
+                running_corrects += (preds == labels).sum()
 
-                running_loss += loss.item() * inputs.size(0)
-                running_corrects += torch.sum(preds == labels.data)
+                batch_len = inputs.size(0)
+                probs_buf[offset:offset + batch_len] = probs[:, 1]
+                labels_buf[offset:offset + batch_len] = labels
+                offset += batch_len
 
-                running_probs.extend(probs[:, 1].tolist())
-                running_labels.extend(labels.tolist())
+            running_probs = probs_buf.cpu().numpy()
+            running_labels = labels_buf.cpu().numpy()
 
-            epoch_loss = running_loss / test_size
-            epoch_acc = running_corrects.double() / test_size
+            epoch_loss = (running_loss / test_size).item()
+            epoch_acc = running_corrects.item() / test_size
             epoch_auc = roc_auc_score(running_labels, running_probs)
-            epoch_sensitivity = recall_score(running_labels, [1 if p > 0.5 else 0 for p in running_probs])
-            epoch_specificity = recall_score(running_labels, [1 if p > 0.5 else 0 for p in running_probs], pos_label=0)
+            running_preds = (running_probs > 0.5).astype(np.int8)
+            epoch_sensitivity = recall_score(running_labels, running_preds)
+            epoch_specificity = recall_score(running_labels, running_preds, pos_label=0)
 
             # 在测试阶段结束后保存预测到CSV
-            save_to_csv(epoch, 'test', running_labels, running_probs, os.path.join(save_dir, 'predictions'))
+            save_to_csv(epoch, 'test', running_labels, running_probs, predictions_dir)
 
-            writer.add_scalar('data/test_loss_epoch', epoch_loss, epoch)
-            writer.add_scalar('data/test_acc_epoch', epoch_acc, epoch)
-            writer.add_scalar('data/test_auc_epoch', epoch_auc, epoch)
-            writer.add_scalar('data/test_sensitivity_epoch', epoch_sensitivity, epoch)
-            writer.add_scalar('data/test_specificity_epoch', epoch_specificity, epoch)
+            epoch_metrics = (epoch_loss, epoch_acc, epoch_auc, epoch_sensitivity, epoch_specificity)
+            for tag, value in zip(scalar_tags['test'], epoch_metrics):
+                writer.add_scalar(tag, value, epoch)
 
             print("[test] Epoch: {}/{} Loss: {} Acc: {} AUC: {} Sensitivity: {} Specificity: {}".format(
                 epoch + 1, nEpochs, epoch_loss, epoch_acc, epoch_auc, epoch_sensitivity, epoch_specificity))